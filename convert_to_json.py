@@ -13,11 +13,19 @@ from os import walk
 from os.path import join, isdir, dirname, basename, splitext
 from os.path import realpath
 from xml.dom import minidom
-import json
 import progressbar
+import utils
 
 
-def convert_txt(folder_input, output):
+def get_value(node, tag, default=None):
+    """ Return the text of the first element `tag` inside `node` """
+    itemlist = node.getElementsByTagName(tag)
+    if not itemlist or not itemlist[0].childNodes:
+        return default
+    return itemlist[0].childNodes[0].data.strip()
+
+
+def convert_txt(folder_input, output, index=False):
     """
     Convert predicted files from LeanNet and Faster R-CNN from plain
     text files (TXT) to JSON file. Unlike ground truth files, predicted
@@ -74,12 +82,10 @@ def convert_txt(folder_input, output):
                     else:
                         dic[image] = [[label, score, xmin, ymin, xmax, ymax]]
 
-    logger.info('Saving file %s' % output)
-    with open(output, 'w') as outfile:
-        json.dump(dic, outfile)
+    utils.save_json(output, dic, index=index)
                     
     
-def convert_xml(folder_input, output):
+def convert_xml(folder_input, output, index=False):
     """
     Convert ground truth files from XML format to JSON format. 
     Each input file represents the bounding boxes identified in
@@ -111,16 +117,22 @@ def convert_xml(folder_input, output):
     The output file contains JSON dictionary with all files in the form:
 
     {"[name of the file].jpg": [
-        [<class>, <score>, <xmin>, <ymin>, <xmax>, <ymax>],
-        [<class>, <score>, <xmin>, <ymin>, <xmax>, <ymax>],
+        [<class>, <score>, <xmin>, <ymin>, <xmax>, <ymax>, <width>, <height>, <difficult>, <truncated>],
+        [<class>, <score>, <xmin>, <ymin>, <xmax>, <ymax>, <width>, <height>, <difficult>, <truncated>],
         ...
       ],
      "[name of the file].jpg": [
-        [<class>, <score>, <xmin>, <ymin>, <xmax>, <ymax>],
-        [<class>, <score>, <xmin>, <ymin>, <xmax>, <ymax>],
+        [<class>, <score>, <xmin>, <ymin>, <xmax>, <ymax>, <width>, <height>, <difficult>, <truncated>],
+        [<class>, <score>, <xmin>, <ymin>, <xmax>, <ymax>, <width>, <height>, <difficult>, <truncated>],
         ...
       ]
     }
+
+    where <width> and <height> are the size of the image (0 if unknown) and
+    <difficult> and <truncated> are the flags of the object (0 if missing).
+    The first six fields keep the same form of predicted files, thus readers
+    that only need the bounding boxes may ignore the remaining fields.
+    Objects of XML files that share the same <filename> are merged.
     """
     dic = {}
     for root, dirs, files in walk(folder_input):
@@ -137,29 +149,30 @@ def convert_xml(folder_input, output):
                 continue
             itemlist = xmlfile.getElementsByTagName('filename')
             filename = itemlist[0].childNodes[0].data
-            
+            width = int(float(get_value(xmlfile, 'width', 0)))
+            height = int(float(get_value(xmlfile, 'height', 0)))
+        
+            objects = []
             itemlist = xmlfile.getElementsByTagName('object')
             for obj in itemlist:
-                for elem in obj.childNodes:
-                    if elem.tagName == 'name':
-                        label = elem.childNodes[0].data
-                    if elem.tagName == 'bndbox':
-                        for item in elem.childNodes:
-                            if item.tagName == 'xmin': xmin = int(item.childNodes[0].data)
-                            if item.tagName == 'ymin': ymin = int(item.childNodes[0].data)
-                            if item.tagName == 'xmax': xmax = int(item.childNodes[0].data)
-                            if item.tagName == 'ymax': ymax = int(item.childNodes[0].data)
-                if dic.has_key(filename):
-                    dic[filename].append([label, 1, xmin, ymin, xmax, ymax])
-                else:
-                    dic[filename]= [[label, 1, xmin, ymin, xmax, ymax]]
-
-    logger.info('Saving file %s' % output)
-    with open(output, 'w') as outfile:
-        json.dump(dic, outfile)
-
-
-def main(folder_input, type_input, output=None):
+                label = get_value(obj, 'name')
+                bndbox = obj.getElementsByTagName('bndbox')[0]
+                xmin = int(float(get_value(bndbox, 'xmin')))
+                ymin = int(float(get_value(bndbox, 'ymin')))
+                xmax = int(float(get_value(bndbox, 'xmax')))
+                ymax = int(float(get_value(bndbox, 'ymax')))
+                difficult = int(get_value(obj, 'difficult', 0))
+                truncated = int(get_value(obj, 'truncated', 0))
+                objects.append([label, 1, xmin, ymin, xmax, ymax, width, height, difficult, truncated])
+            # several XML files may annotate the same image
+            if dic.has_key(filename):
+                dic[filename].extend(objects)
+            else:
+                dic[filename] = objects
+    utils.save_json(output, dic, index=index)
+
+
+def main(folder_input, type_input, output=None, index=False):
     folder_input = realpath(folder_input)
     if not isdir(folder_input):
         logger.error('Input is not a folder: %s' % folder_input)
@@ -170,9 +183,9 @@ def main(folder_input, type_input, output=None):
         output = join(folder_input, fname+'.json')
 
     if type_input.lower() == 'xml':
-        convert_xml(folder_input, output)
+        convert_xml(folder_input, output, index=index)
     elif type_input.lower() == 'txt':
-        convert_txt(folder_input, output)
+        convert_txt(folder_input, output, index=index)
     else:
         logger.error('Type of files is not correct: %s' % type_input)
         sys.error(0)
@@ -183,6 +196,7 @@ if __name__ == "__main__":
     parser.add_argument('inputfolder', metavar='folder_input', help='Folder containing files to be converted.')
     parser.add_argument('type', metavar='file_type', help='Type of input files (default: xml)', default='xml')
     parser.add_argument('-o', '--output', help='File to save the generated json file', default=None)
+    parser.add_argument('-i', '--index', help='Save an index of the images (<output>.idx) for random access', action='store_true')
     args = parser.parse_args()
 
-    main(args.inputfolder, args.type, output=args.output)
+    main(args.inputfolder, args.type, output=args.output, index=args.index)
@@ -21,11 +21,19 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
 import argparse
 import sys
-from os.path import join, isdir, dirname, basename, splitext, realpath
+from os.path import join, isdir, isfile, dirname, basename, splitext, realpath
 import json
+import time
+import hashlib
 import numpy as np
 import utils
 
+# number of boxes in an image above which the spatial grid index is used
+GRID_MIN_BOXES = 1000
+# default edges of object size buckets (small, medium, large) for each mode
+SIZE_EDGES = {'area': [32**2, 96**2], 'ratio': [0.01, 0.1]}
+# methods to match predicted and ground truth boxes
+MATCHINGS = ['greedy', 'optimal']
 
 def accurary_scores(dresults):
     """
@@ -55,10 +63,135 @@ def accurary_scores(dresults):
         f_score = 0.0
     return (precision, recall, f_score)
 
+
+def bootstrap_scores(true_pos, false_pos, false_neg, n_samples, alpha=0.05, seed=0,
+                     strata=None, weights=None):
+    """
+    Estimate percentile confidence intervals of dataset-level precision,
+    recall and F-score by resampling images with replacement. Each resample
+    is represented by the number of times each image is drawn, thus all
+    resamples are computed as a product between the count matrix and the
+    per-image arrays of true positives, false positives and false negatives.
+
+    Parameters:
+    -----------
+    true_pos : array
+        number of true positives of each image
+    false_pos : array
+        number of false positives of each image
+    false_neg : array
+        number of false negatives of each image
+    n_samples : int
+        number of bootstrap resamples
+    alpha : float
+        confidence level of the interval is 1 - alpha
+    seed : int
+        seed of the random generator
+    strata : array
+        stratum of each image for stratified samples. Images are resampled
+        within their own stratum.
+    weights : array
+        number of images of the dataset represented by each image, i.e., the
+        inverse of the sampling fraction of its stratum
+
+    Returns:
+    --------
+        dict: {'precision': (score, low, high), 'recall': (...), 'f_score': (...)}
+    """
+    counts = np.vstack((true_pos, false_pos, false_neg)).T.astype(np.float64)
+    n_images = len(counts)
+    if weights is not None:
+        counts *= np.asarray(weights, dtype=np.float64)[:, None]
+    if strata is None:
+        strata = np.zeros(n_images, dtype=np.int64)
+    groups = [np.nonzero(strata == stratum)[0] for stratum in np.unique(strata)]
+    rng = np.random.RandomState(seed)
+    # limit the size of the count matrix to about 10M entries per batch
+    batch = max(1, int(1e7 // max(n_images, 1)))
+    totals = []
+    for start in range(0, n_samples, batch):
+        size = min(batch, n_samples - start)
+        draws = np.hstack([group[rng.randint(0, len(group), (size, len(group)))]
+                           for group in groups])
+        draws += np.arange(size)[:, None] * n_images
+        resample = np.bincount(draws.ravel(), minlength=size*n_images).reshape(size, n_images)
+        totals.append(resample.dot(counts))
+    totals = np.vstack(totals)
+    tp, fp, fn = totals[:, 0], totals[:, 1], totals[:, 2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(tp + fp > 0, tp / (tp + fp), 0.0)
+        recall = np.where(tp + fn > 0, tp / (tp + fn), 0.0)
+        f_score = np.where(precision + recall > 0,
+                           2 * precision * recall / (precision + recall), 0.0)
+
+    total = counts.sum(axis=0)
+    scores = accurary_scores({'true_pos': total[0], 'false_pos': total[1], 'false_neg': total[2]})
+    dic = {}
+    for name, score, values in zip(['precision', 'recall', 'f_score'], scores,
+                                   [precision, recall, f_score]):
+        low, high = np.percentile(values, [100*alpha/2, 100*(1-alpha/2)])
+        dic[name] = (score, low, high)
+    return dic
+
+
+def stratified_sample(dgt, images, sample, seed=0):
+    """
+    Select a random subset of images stratified by the classes present in
+    the ground truth. Each image belongs to the stratum of its rarest class
+    (images without ground truth form their own stratum) and each stratum
+    is sampled proportionally to its size, with at least one image.
+
+    Parameters:
+    -----------
+    dgt : dict
+        ground truth in the form {image: [[<class>, <score>, <xmin>, <ymin>, <xmax>, <ymax>], ...]}
+    images : list
+        names of the images to sample from, i.e., images of the ground truth
+        and of the predicted file, otherwise images without predictions are
+        never sampled and the estimated recall is biased
+    sample : float
+        fraction of images to sample (if < 1) or number of images (if >= 1)
+    seed : int
+        seed of the random generator
+
+    Returns:
+    --------
+        tuple: lists (images, strata, weights) of the sampled images, where
+            `weights` is the number of images represented by each sampled image
+    """
+    frequency = {}
+    for img in images:
+        for label in set([obj[0] for obj in dgt.get(img, [])]):
+            frequency[label] = frequency.get(label, 0) + 1
+    dstrata = {}
+    for img in images:
+        labels = sorted(set([obj[0] for obj in dgt.get(img, [])]),
+                        key=lambda label: (frequency[label], label))
+        stratum = labels[0] if labels else None
+        if dstrata.has_key(stratum):
+            dstrata[stratum].append(img)
+        else:
+            dstrata[stratum] = [img]
+
+    fraction = sample if sample < 1 else float(sample) / max(len(images), 1)
+    rng = np.random.RandomState(seed)
+    samples = []
+    for id, stratum in enumerate(sorted(dstrata)):
+        group = sorted(dstrata[stratum])
+        n = min(len(group), max(1, int(round(fraction * len(group)))))
+        weight = float(len(group)) / n
+        for idx in rng.choice(len(group), n, replace=False):
+            samples.append((group[idx], id, weight))
+    samples.sort()
+    return [img for img, _, _ in samples], [id for _, id, _ in samples], \
+           [weight for _, _, weight in samples]
+
 ####################
 def calculate_iou(g_bbox, p_bbox):
     """
-    Calculate Intersection over Union (IoU) of a pair of bounding boxes
+    Calculate Intersection over Union (IoU) of a pair of bounding boxes.
+    Boxes are not checked here, they are expected to be validated with
+    `utils.validate_boxes` beforehand.
 
     Parameters:
     -----------
@@ -74,19 +207,14 @@ def calculate_iou(g_bbox, p_bbox):
     g_xmin, g_ymin, g_xmax, g_ymax = g_bbox
     p_xmin, p_ymin, p_xmax, p_ymax = p_bbox
 
-    if (g_xmin > g_xmax) or (g_ymin > g_bbox) or \
-       (p_xmin > p_xmax) or (p_ymin > p_bbox):
-        logger.error('Bounding box contain errors, e.g., xmin>max')
-        sys.exit(0)
-
     if (g_xmax < p_xmin or p_xmax < g_xmin or \
         g_ymax < p_ymin or p_ymax < g_ymin):
         return 0.0
 
-    far_x = np.min([g_xmax, p_xmax])
-    near_x = np.max([g_xmin, p_xmin])
-    far_y = np.min([g_ymax, p_ymax])
-    near_y = np.max([g_ymin, p_ymin])
+    far_x = min(g_xmax, p_xmax)
+    near_x = max(g_xmin, p_xmin)
+    far_y = min(g_ymax, p_ymax)
+    near_y = max(g_ymin, p_ymin)
 
     inter_area = (far_x - near_x + 1) * (far_y - near_y + 1)
     true_box_area = (g_xmax - g_xmin + 1) * (g_ymax - g_ymin + 1)
@@ -95,176 +223,970 @@ def calculate_iou(g_bbox, p_bbox):
     return iou
 
 
-def get_single_image_results(gt_boxes, pred_boxes, iou_thr):
-    """Calculates number of true_pos, false_pos, false_neg from single batch of boxes.
+def iou_matrix(gt_boxes, pred_boxes):
+    """
+    Calculate the dense matrix of IoU between all ground truth and
+    predicted bounding boxes of an image
 
-    Args:
-        gt_boxes (list of list of floats): list of locations of ground truth
-            objects as [xmin, ymin, xmax, ymax]
-        pred_boxes (dict): dict of dicts of 'boxes' (formatted like `gt_boxes`)
-            and 'scores'
-        iou_thr (float): value of IoU to consider as threshold for a
-            true prediction.
+    Parameters:
+    -----------
+        gt_boxes: array
+            N x 4 ground truth bounding boxes in the form [xmin, ymin, xmax, ymax]
+        pred_boxes: array
+            M x 4 predicted bounding boxes in the form [xmin, ymin, xmax, ymax]
 
     Returns:
-        dict: true positives (int), false positives (int), false negatives (int)
-    """
-    all_pred_indices = range(len(pred_boxes))
-    all_gt_indices = range(len(gt_boxes))
-    if len(all_pred_indices) == 0:
-        tp = 0
-        fp = 0
-        fn = len(gt_boxes)
-        return {'true_pos': tp, 'false_pos': fp, 'false_neg': fn}
-    if len(all_gt_indices) == 0:
-        tp = 0
-        fp = len(pred_boxes)
-        fn = 0
-        return {'true_pos': tp, 'false_pos': fp, 'false_neg': fn}
-
-    gt_idx_thr = []
-    pred_idx_thr = []
-    ious = []
-    for ipb, pred_box in enumerate(pred_boxes):
-        for igb, gt_box in enumerate(gt_boxes):
-            iou = calculate_iou(pred_box, gt_box)
-            if iou > iou_thr:
-                gt_idx_thr.append(igb)
-                pred_idx_thr.append(ipb)
-                ious.append(iou)
-
-    args_desc = np.argsort(ious)[::-1]
-    if len(args_desc) == 0:
-        # No matches
-        tp = 0
-        fp = len(pred_boxes)
-        fn = len(gt_boxes)
-    else:
-        gt_match_idx = []
-        pred_match_idx = []
-        for idx in args_desc:
-            gt_idx = gt_idx_thr[idx]
-            pr_idx = pred_idx_thr[idx]
-            # If the boxes are unmatched, add them to matches
-            if (gt_idx not in gt_match_idx) and (pr_idx not in pred_match_idx):
-                gt_match_idx.append(gt_idx)
-                pred_match_idx.append(pr_idx)
-        tp = len(gt_match_idx)
-        fp = len(pred_boxes) - len(pred_match_idx)
-        fn = len(gt_boxes) - len(gt_match_idx)
-
-    return {'true_pos': tp, 'false_pos': fp, 'false_neg': fn}
-
-
-######################
-def select_by_class(dic):
-    """ For each image, create a dictionary with {label: [[bbox1], [bbox2],...]}
-    """
-    dclass = {}
-    for img in sorted(dic):
-        dcontent = {}
-        for label, bbox in zip(dic[img]['classes'], dic[img]['boxes']):
-            if dcontent.has_key(label):
-                dcontent[label].append(bbox)
+    --------
+        array: M x N matrix with the IoU of each predicted and ground truth box
+    """
+    g = np.asarray(gt_boxes, dtype=np.float64).reshape(-1, 4)
+    p = np.asarray(pred_boxes, dtype=np.float64).reshape(-1, 4)
+    far_x = np.minimum(p[:, 2, None], g[None, :, 2])
+    near_x = np.maximum(p[:, 0, None], g[None, :, 0])
+    far_y = np.minimum(p[:, 3, None], g[None, :, 3])
+    near_y = np.maximum(p[:, 1, None], g[None, :, 1])
+    # boxes that do not overlap have no intersection, as in `calculate_iou`
+    inter_w = np.where(far_x < near_x, 0, far_x - near_x + 1)
+    inter_h = np.where(far_y < near_y, 0, far_y - near_y + 1)
+    inter_area = inter_w * inter_h
+    true_box_area = (g[:, 2] - g[:, 0] + 1) * (g[:, 3] - g[:, 1] + 1)
+    p_bbox_area = (p[:, 2] - p[:, 0] + 1) * (p[:, 3] - p[:, 1] + 1)
+    return inter_area / (p_bbox_area[:, None] + true_box_area[None, :] - inter_area)
+
+
+def pair_iou(gt_boxes, pred_boxes, gt_idx, pred_idx):
+    """
+    Calculate IoU only for the pairs of boxes given by `gt_idx` and `pred_idx`
+
+    Parameters:
+    -----------
+        gt_boxes: array
+            N x 4 ground truth bounding boxes in the form [xmin, ymin, xmax, ymax]
+        pred_boxes: array
+            M x 4 predicted bounding boxes in the form [xmin, ymin, xmax, ymax]
+        gt_idx: array
+            indices of ground truth boxes of each pair
+        pred_idx: array
+            indices of predicted boxes of each pair
+
+    Returns:
+    --------
+        array: IoU of each pair
+    """
+    g = np.asarray(gt_boxes, dtype=np.float64).reshape(-1, 4)[gt_idx]
+    p = np.asarray(pred_boxes, dtype=np.float64).reshape(-1, 4)[pred_idx]
+    far_x = np.minimum(g[:, 2], p[:, 2])
+    near_x = np.maximum(g[:, 0], p[:, 0])
+    far_y = np.minimum(g[:, 3], p[:, 3])
+    near_y = np.maximum(g[:, 1], p[:, 1])
+    # boxes that do not overlap have no intersection, as in `calculate_iou`
+    inter_w = np.where(far_x < near_x, 0, far_x - near_x + 1)
+    inter_h = np.where(far_y < near_y, 0, far_y - near_y + 1)
+    inter_area = inter_w * inter_h
+    true_box_area = (g[:, 2] - g[:, 0] + 1) * (g[:, 3] - g[:, 1] + 1)
+    p_bbox_area = (p[:, 2] - p[:, 0] + 1) * (p[:, 3] - p[:, 1] + 1)
+    return inter_area / (true_box_area + p_bbox_area - inter_area)
+
+
+def _grid_cells(boxes, cell_size):
+    """ Return the (x, y) cells covered by each box and the index of the box """
+    cells = np.floor(boxes / cell_size).astype(np.int64)
+    nx = cells[:, 2] - cells[:, 0] + 1
+    ny = cells[:, 3] - cells[:, 1] + 1
+    counts = nx * ny
+    idx = np.repeat(np.arange(len(boxes)), counts)
+    starts = np.cumsum(counts) - counts
+    offset = np.arange(counts.sum()) - np.repeat(starts, counts)
+    cx = cells[idx, 0] + offset % nx[idx]
+    cy = cells[idx, 1] + offset // nx[idx]
+    return cx, cy, idx
+
+
+def candidate_pairs(gt_boxes, pred_boxes, cell_size=None):
+    """
+    Generate pairs of ground truth and predicted boxes that overlap using
+    a uniform grid as spatial index. Boxes are inserted into every cell they
+    cover and only boxes sharing a cell are compared, thus the dense N x M
+    comparison is avoided for images containing many boxes.
+
+    Parameters:
+    -----------
+        gt_boxes: array
+            N x 4 ground truth bounding boxes in the form [xmin, ymin, xmax, ymax]
+        pred_boxes: array
+            M x 4 predicted bounding boxes in the form [xmin, ymin, xmax, ymax]
+        cell_size: float
+            size of the (square) cells of the grid. When None, the median of
+            the largest side of the boxes is used.
+
+    Returns:
+    --------
+        tuple: arrays (gt_idx, pred_idx) of overlapping pairs, sorted by
+            predicted and then ground truth index
+    """
+    g = np.asarray(gt_boxes, dtype=np.float64).reshape(-1, 4)
+    p = np.asarray(pred_boxes, dtype=np.float64).reshape(-1, 4)
+    empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    if len(g) == 0 or len(p) == 0:
+        return empty
+    if not cell_size:
+        boxes = np.vstack((g, p))
+        sides = np.maximum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]) + 1
+        cell_size = max(float(np.median(sides)), 1.0)
+
+    g_cx, g_cy, g_idx = _grid_cells(g, cell_size)
+    p_cx, p_cy, p_idx = _grid_cells(p, cell_size)
+    min_x = min(g_cx.min(), p_cx.min())
+    min_y = min(g_cy.min(), p_cy.min())
+    width = max(g_cx.max(), p_cx.max()) - min_x + 1
+    g_key = (g_cy - min_y) * width + (g_cx - min_x)
+    p_key = (p_cy - min_y) * width + (p_cx - min_x)
+
+    # join cells of predicted boxes with cells of ground truth boxes
+    order = np.argsort(g_key, kind='mergesort')
+    g_key, g_idx = g_key[order], g_idx[order]
+    left = np.searchsorted(g_key, p_key, side='left')
+    right = np.searchsorted(g_key, p_key, side='right')
+    counts = right - left
+    if counts.sum() == 0:
+        return empty
+    starts = np.cumsum(counts) - counts
+    pos = np.repeat(left - starts, counts) + np.arange(counts.sum())
+    cand_gt = g_idx[pos]
+    cand_pred = np.repeat(p_idx, counts)
+
+    # remove pairs that share more than one cell and pairs that do not overlap
+    codes = np.unique(cand_pred * len(g) + cand_gt)
+    cand_pred = codes // len(g)
+    cand_gt = codes % len(g)
+    gb, pb = g[cand_gt], p[cand_pred]
+    overlap = (gb[:, 0] <= pb[:, 2]) & (pb[:, 0] <= gb[:, 2]) & \
+              (gb[:, 1] <= pb[:, 3]) & (pb[:, 1] <= gb[:, 3])
+    return cand_gt[overlap], cand_pred[overlap]
+
+
+def linear_assignment(weights):
+    """
+    Solve the assignment problem maximizing the total weight using shortest
+    augmenting paths with dual potentials (Jonker-Volgenant style). Each row
+    is assigned to a distinct column (or the opposite when there are more
+    rows than columns).
+
+    Parameters:
+    -----------
+        weights: array
+            N x M matrix of weights of assigning row i to column j
+
+    Returns:
+    --------
+        list: pairs (row, column) of the assignment
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    transpose = weights.shape[0] > weights.shape[1]
+    cost = -(weights.T if transpose else weights)
+    n, m = cost.shape
+    u = np.zeros(n+1)
+    v = np.zeros(m+1)
+    # p[j]: row (1-based) assigned to column j; way[j]: previous column in the path
+    p = np.zeros(m+1, dtype=np.int64)
+    way = np.zeros(m+1, dtype=np.int64)
+    for i in range(1, n+1):
+        p[0] = i
+        j0 = 0
+        minv = np.full(m+1, np.inf)
+        used = np.zeros(m+1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            free = ~used
+            free[0] = False
+            reduced = cost[i0-1] - u[i0] - v[1:]
+            update = free[1:] & (reduced < minv[1:])
+            minv[1:][update] = reduced[update]
+            way[1:][update] = j0
+            candidates = np.where(free, minv, np.inf)
+            j1 = int(np.argmin(candidates))
+            delta = candidates[j1]
+            u[p[used]] += delta
+            v[used] -= delta
+            minv[free] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        # augment the assignment along the path
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+    pairs = [(int(p[j]-1), j-1) for j in range(1, m+1) if p[j]]
+    if transpose:
+        pairs = [(col, row) for row, col in pairs]
+    return pairs
+
+
+def _optimal_matches(gt_idx, pred_idx, ious):
+    """
+    Find the one-to-one matches maximizing the total IoU of the candidate
+    pairs. Pairs are split into connected components, thus the assignment
+    is solved for small groups of overlapping boxes instead of the whole image.
+    """
+    parent = {}
+    def find(node):
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+    for gt_id, pr_id in zip(gt_idx, pred_idx):
+        a, b = ('g', gt_id), ('p', pr_id)
+        parent.setdefault(a, a)
+        parent.setdefault(b, b)
+        parent[find(a)] = find(b)
+    components = {}
+    for k, gt_id in enumerate(gt_idx):
+        root = find(('g', gt_id))
+        if components.has_key(root):
+            components[root].append(k)
+        else:
+            components[root] = [k]
+
+    matches = []
+    for root in components:
+        pairs = components[root]
+        gts = sorted(set(int(gt_idx[k]) for k in pairs))
+        preds = sorted(set(int(pred_idx[k]) for k in pairs))
+        g_pos = dict((gt_id, i) for i, gt_id in enumerate(gts))
+        p_pos = dict((pr_id, j) for j, pr_id in enumerate(preds))
+        weights = np.zeros((len(gts), len(preds)))
+        for k in pairs:
+            weights[g_pos[gt_idx[k]], p_pos[pred_idx[k]]] = ious[k]
+        for i, j in linear_assignment(weights):
+            # pairs below the threshold have weight 0 and are not matches
+            if weights[i, j] > 0:
+                matches.append((weights[i, j], gts[i], preds[j]))
+    matches.sort(key=lambda match: -match[0])
+    return [gt_id for _, gt_id, _ in matches], [pr_id for _, _, pr_id in matches]
+
+
+def match_boxes(gt_boxes, pred_boxes, iou_thr, use_grid=None, matching='greedy'):
+    """
+    Match predicted and ground truth boxes greedily by descending IoU or by
+    the optimal one-to-one assignment that maximizes the total IoU.
+
+    Parameters:
+    -----------
+        gt_boxes: list
+            ground truth bounding boxes in the form [xmin, ymin, xmax, ymax]
+        pred_boxes: list
+            predicted bounding boxes in the form [xmin, ymin, xmax, ymax]
+        iou_thr: float
+            value of IoU to consider as threshold for a true prediction
+        use_grid: bool
+            use the spatial grid index to generate candidate pairs. When None,
+            the grid is used if the image contains more than GRID_MIN_BOXES boxes.
+        matching: string
+            `greedy` (default) or `optimal` assignment of boxes
+
+    Returns:
+    --------
+        tuple: lists (gt_match_idx, pred_match_idx) of matched boxes
+    """
+    if matching not in MATCHINGS:
+        logger.error('Matching of bounding boxes is not correct: %s' % matching)
+        sys.exit(1)
+    if len(gt_boxes) == 0 or len(pred_boxes) == 0:
+        return [], []
+    gt_idx, pred_idx, ious = _candidate_ious(gt_boxes, pred_boxes, iou_thr, use_grid)
+    if matching == 'optimal':
+        return _optimal_matches(gt_idx, pred_idx, ious)
+    order = np.argsort(-ious, kind='mergesort')
+    return _greedy_matches(gt_idx[order], pred_idx[order], len(gt_boxes), len(pred_boxes))
+
+
+def score_matches(gt_boxes, pred_boxes, scores, iou_thr, use_grid=None):
+    """
+    Match predicted boxes in descending order of score, each one to the
+    unmatched ground truth box with highest IoU, as in the standard
+    definition of average precision. Unlike `match_boxes`, a prediction
+    with high score is never left unmatched by one with lower score.
+
+    Returns:
+    --------
+        list: 1 for each matched predicted box and 0 otherwise
+    """
+    if len(gt_boxes) == 0 or len(pred_boxes) == 0:
+        return [0] * len(pred_boxes)
+    gt_idx, pred_idx, ious = _candidate_ious(gt_boxes, pred_boxes, iou_thr, use_grid)
+    scores = np.asarray(scores, dtype=np.float64)
+    # pairs sorted by score of the prediction, then by IoU
+    order = np.lexsort((-ious, pred_idx, -scores[pred_idx]))
+    _, pred_match_idx = _greedy_matches(gt_idx[order], pred_idx[order], len(gt_boxes),
+                                        len(pred_boxes))
+    matched = [0] * len(pred_boxes)
+    for pr_id in pred_match_idx:
+        matched[pr_id] = 1
+    return matched
+
+
+def _candidate_ious(gt_boxes, pred_boxes, iou_thr, use_grid=None):
+    """ Return arrays (gt_idx, pred_idx, ious) of the pairs of boxes with IoU above `iou_thr` """
+    if use_grid is None:
+        use_grid = len(gt_boxes) + len(pred_boxes) > GRID_MIN_BOXES
+    if use_grid:
+        gt_idx, pred_idx = candidate_pairs(gt_boxes, pred_boxes)
+        ious = pair_iou(gt_boxes, pred_boxes, gt_idx, pred_idx)
+        keep = ious > iou_thr
+        return gt_idx[keep], pred_idx[keep], ious[keep]
+    matrix = iou_matrix(gt_boxes, pred_boxes)
+    pred_idx, gt_idx = np.nonzero(matrix > iou_thr)
+    return gt_idx, pred_idx, matrix[pred_idx, gt_idx]
+
+
+def _greedy_matches(gt_idx, pred_idx, n_gt, n_pred):
+    """ Match the pairs of boxes in the given order, skipping boxes already matched """
+    gt_matched = np.zeros(n_gt, dtype=bool)
+    pred_matched = np.zeros(n_pred, dtype=bool)
+    gt_match_idx = []
+    pred_match_idx = []
+    for gt_id, pr_id in zip(gt_idx, pred_idx):
+        # If the boxes are unmatched, add them to matches
+        if not gt_matched[gt_id] and not pred_matched[pr_id]:
+            gt_matched[gt_id] = True
+            pred_matched[pr_id] = True
+            gt_match_idx.append(int(gt_id))
+            pred_match_idx.append(int(pr_id))
+    return gt_match_idx, pred_match_idx
+
+
+class ResultCache(object):
+    """
+    Cache of the partial results of each image, i.e., counts and score records
+    for each class. Entries are keyed by a hash of the ground truth boxes, the
+    predicted boxes and the parameters of the evaluation, thus re-evaluating a
+    file where only a few images changed matches only those images, while the
+    remaining ones are aggregated from the cache.
+    """
+    def __init__(self, input=None):
+        self.entries = {}
+        self.used = {}
+        self.hits = 0
+        self.misses = 0
+        if input and isfile(input):
+            logger.info('Reading file %s' % input)
+            with utils.open_file(input) as infile:
+                self.entries = json.load(infile)
+
+    # changes whenever the content of the partial results changes
+    version = 2
+
+    def key(self, ground, predicted, *params):
+        """ Return the hash of the content of an image and the parameters """
+        content = json.dumps([ground, predicted, params, self.version], sort_keys=True)
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def get(self, image, key):
+        entry = self.entries.get(image)
+        if entry and entry[0] == key:
+            self.hits += 1
+            self.used[image] = entry
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def put(self, image, key, partial):
+        self.used[image] = [key, partial]
+
+    def save(self, output):
+        """ Save the entries used in the last evaluation """
+        logger.info('Saving file %s' % output)
+        logger.info('Cached images: %d Re-evaluated images: %d' % (self.hits, self.misses))
+        with utils.open_file(output, 'w') as outfile:
+            json.dump(self.used, outfile)
+
+
+class Evaluator(object):
+    """
+    Accumulate the evaluation of images incrementally, e.g., while a detector
+    is running. For each class, the evaluator keeps the running number of
+    true positives, false positives and false negatives, as well as the score
+    of each predicted box and whether it was matched, which allows computing
+    the average precision. Partial evaluators (e.g. from other processes or
+    machines) are combined exactly with `merge()` and may be saved and loaded
+    as JSON files.
+
+    Usage:
+    ------
+        evaluator = Evaluator(iou_thr=0.5)
+        for image in images:
+            evaluator.add(image, ground[image], predicted[image])
+        precision, recall, f_score = evaluator.scores()
+
+    When `size_mode` is set, the same matches are also accumulated into one
+    evaluator for each bucket of object size (available in `sizes`). Buckets
+    are defined by the absolute area of the boxes (`area`) or by the ratio
+    between the area of the boxes and the area of the image (`ratio`). Ground
+    truth and unmatched predicted boxes fall in the bucket of their own size,
+    while matched predicted boxes fall in the bucket of their ground truth box.
+
+    When `ignore_difficult` is True, ground truth boxes flagged as difficult
+    (see `convert_to_json.convert_xml`) and the predicted boxes matched to
+    them are not counted. Boxes are matched greedily unless `matching` is
+    `optimal` (see `match_boxes`).
+    """
+    def __init__(self, iou_thr=0.5, size_mode=None, size_edges=None, ignore_difficult=False,
+                 matching='greedy'):
+        self.iou_thr = iou_thr
+        self.ignore_difficult = ignore_difficult
+        self.matching = matching
+        self.counts = {}
+        self.records = {}
+        self.images = set()
+        self.size_mode = size_mode
+        self.size_edges = None
+        self.sizes = {}
+        if matching not in MATCHINGS:
+            logger.error('Matching of bounding boxes is not correct: %s' % matching)
+            sys.exit(1)
+        if size_mode:
+            if not SIZE_EDGES.has_key(size_mode):
+                logger.error('Mode of object size is not correct: %s' % size_mode)
+                sys.exit(1)
+            self.size_edges = sorted(size_edges or SIZE_EDGES[size_mode])
+            for name in self.size_names():
+                self.sizes[name] = Evaluator(iou_thr=iou_thr, ignore_difficult=ignore_difficult,
+                                             matching=matching)
+
+    def size_names(self):
+        """ Return the names of the size buckets, from smallest to largest """
+        if not self.size_edges:
+            return []
+        edges = ['%g' % edge for edge in self.size_edges]
+        names = ['<%s' % edges[0]]
+        names += ['%s-%s' % (low, high) for low, high in zip(edges[:-1], edges[1:])]
+        names.append('>=%s' % edges[-1])
+        return names
+
+    def _size_buckets(self, boxes, area_img):
+        """ Return the name of the size bucket of each box """
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        if self.size_mode == 'ratio':
+            areas = areas / area_img
+        names = self.size_names()
+        return [names[i] for i in np.searchsorted(self.size_edges, areas, side='right')]
+
+    def add(self, image, ground, predicted, size=None, cache=None):
+        """
+        Evaluate a single image and accumulate its results
+
+        Parameters:
+        -----------
+        image : string
+            name of the image
+        ground : list
+            ground truth objects in the form [<class>, <score>, <xmin>, <ymin>, <xmax>, <ymax>]
+        predicted : list
+            predicted objects in the form [<class>, <score>, <xmin>, <ymin>, <xmax>, <ymax>]
+        size : tuple
+            (width, height) of the image, used when `size_mode` is `ratio`. Images
+            without size are left out of the size buckets.
+        cache : ResultCache
+            cache of partial results; the image is only matched again when
+            its boxes or the parameters of the evaluation changed
+
+        Returns:
+        --------
+            dict: {label: {'true_pos': int, 'false_pos': int, 'false_neg': int}}
+        """
+        area_img = None
+        if self.size_mode == 'ratio':
+            if size:
+                area_img = float(size[0] * size[1])
             else:
-                dcontent[label] = [bbox]
-        dclass[img] = dcontent
-    return dclass
-
-
-def image_results(g_img, p_img):
-    all_classes = set(g_img.keys()+p_img.keys())
-    results = { 'false_pos': 0, 'true_pos': 0, 'false_neg': 0 }
-    for label in all_classes:
-        if not g_img.has_key(label): g_img[label] = []
-        if not p_img.has_key(label): p_img[label] = []
-        dres = get_single_image_results(g_img[label], p_img[label], 0.5)
-        results['false_pos'] += dres['false_pos']
-        results['true_pos'] += dres['true_pos']
-        results['false_neg'] += dres['false_neg']
-    return results
+                logger.warning('Image without size is not included in the size buckets: %s' % image)
+        if image in self.images:
+            logger.warning('Image already evaluated: %s' % image)
+        self.images.add(image)
 
-    
-def generate_results(file_ground, file_pred, output=None):
+        partial = None
+        if cache is not None:
+            key = cache.key(ground, predicted, self.iou_thr, self.size_mode, self.size_edges,
+                            size, self.ignore_difficult, self.matching)
+            partial = cache.get(image, key)
+        if partial is None:
+            partial = self._evaluate(ground, predicted, area_img)
+            if cache is not None:
+                cache.put(image, key, partial)
+
+        dimg = {}
+        for label in partial:
+            dres, records, dsizes = partial[label]
+            self._accumulate(label, dres, records)
+            for name in dsizes:
+                self.sizes[name]._accumulate(label, dsizes[name][0], dsizes[name][1])
+            dimg[label] = dres
+        return dimg
+
+    def match_image(self, ground, predicted):
+        """
+        Match the boxes of a single image with the parameters of the evaluator.
+        Returns a dictionary {label: (ground, predicted, gt_match_idx, pred_match_idx)}
+        with the objects of each class that are evaluated (difficult objects
+        are removed when `ignore_difficult` is True) and the indices of the
+        matched objects.
+        """
+        g_img = {}
+        for obj in ground:
+            if g_img.has_key(obj[0]):
+                g_img[obj[0]].append(obj)
+            else:
+                g_img[obj[0]] = [obj]
+        p_img = {}
+        for obj in predicted:
+            if p_img.has_key(obj[0]):
+                p_img[obj[0]].append(obj)
+            else:
+                p_img[obj[0]] = [obj]
+
+        dmatches = {}
+        for label in set(g_img.keys()+p_img.keys()):
+            vg = g_img.get(label, [])
+            vp = p_img.get(label, [])
+            gt_match_idx, pred_match_idx = match_boxes([obj[2:6] for obj in vg],
+                                                       [obj[2:6] for obj in vp], self.iou_thr,
+                                                       matching=self.matching)
+            if self.ignore_difficult:
+                vg, vp, gt_match_idx, pred_match_idx = self._remove_difficult(
+                    vg, vp, gt_match_idx, pred_match_idx)
+            dmatches[label] = (vg, vp, gt_match_idx, pred_match_idx)
+        return dmatches
+
+    def _evaluate(self, ground, predicted, area_img):
+        """
+        Match the boxes of a single image. Returns the partial results of the
+        image in the form {label: [counts, records, {size: [counts, records]}]}
+        """
+        dmatches = self.match_image(ground, predicted)
+        partial = {}
+        for label in dmatches:
+            vg, vp, gt_match_idx, pred_match_idx = dmatches[label]
+            dres = {'true_pos': len(gt_match_idx),
+                    'false_pos': len(vp) - len(pred_match_idx),
+                    'false_neg': len(vg) - len(gt_match_idx)}
+            # average precision ranks predictions by score, thus its records
+            # come from matching the boxes in the order of the scores
+            ap_matched = score_matches([obj[2:6] for obj in vg], [obj[2:6] for obj in vp],
+                                       [obj[1] for obj in vp], self.iou_thr)
+            records = [[obj[1], ap_matched[i]] for i, obj in enumerate(vp)]
+            dsizes = {}
+            # images without size cannot be split by ratio, they only count in the totals
+            if self.size_mode and (self.size_mode != 'ratio' or area_img):
+                dsizes = self._split_sizes(vg, vp, gt_match_idx, pred_match_idx,
+                                           records, area_img)
+            partial[label] = [dres, records, dsizes]
+        return partial
+
+    def _remove_difficult(self, vg, vp, gt_match_idx, pred_match_idx):
+        """
+        Remove ground truth boxes flagged as difficult and the predicted boxes
+        matched to them, thus they count neither as hits nor as errors
+        """
+        difficult = [len(obj) > 8 and bool(obj[8]) for obj in vg]
+        ignored = set([pr_id for gt_id, pr_id in zip(gt_match_idx, pred_match_idx) if difficult[gt_id]])
+        kept_gt = [i for i in range(len(vg)) if not difficult[i]]
+        kept_pred = [i for i in range(len(vp)) if i not in ignored]
+        gt_map = dict((i, j) for j, i in enumerate(kept_gt))
+        pred_map = dict((i, j) for j, i in enumerate(kept_pred))
+        pairs = [(gt_map[gt_id], pred_map[pr_id])
+                 for gt_id, pr_id in zip(gt_match_idx, pred_match_idx) if not difficult[gt_id]]
+        return [vg[i] for i in kept_gt], [vp[i] for i in kept_pred], \
+               [gt_id for gt_id, _ in pairs], [pr_id for _, pr_id in pairs]
+
+    def _split_sizes(self, vg, vp, gt_match_idx, pred_match_idx, records, area_img):
+        """ Split the matches of a class into size buckets """
+        g_bucket = self._size_buckets([obj[2:6] for obj in vg], area_img)
+        p_bucket = self._size_buckets([obj[2:6] for obj in vp], area_img)
+        for gt_id, pr_id in zip(gt_match_idx, pred_match_idx):
+            p_bucket[pr_id] = g_bucket[gt_id]
+        matched_gt = set(gt_match_idx)
+        matched_pred = set(pred_match_idx)
+        dsizes = {}
+        for name in self.size_names():
+            dsizes[name] = [{'true_pos': 0, 'false_pos': 0, 'false_neg': 0}, []]
+        for i, name in enumerate(g_bucket):
+            dsizes[name][0]['true_pos' if i in matched_gt else 'false_neg'] += 1
+        for i, name in enumerate(p_bucket):
+            if i not in matched_pred:
+                dsizes[name][0]['false_pos'] += 1
+            dsizes[name][1].append(records[i])
+        return dsizes
+
+    def _accumulate(self, label, dres, records):
+        """ Add counts and score records of a class """
+        if not self.counts.has_key(label):
+            self.counts[label] = {'true_pos': 0, 'false_pos': 0, 'false_neg': 0}
+            self.records[label] = []
+        for key in dres:
+            self.counts[label][key] += dres[key]
+        self.records[label].extend(records)
+
+    def merge(self, other):
+        """
+        Add the results of another evaluator into this one. Raises ValueError
+        when the evaluators were created with different parameters.
+        """
+        if other.iou_thr != self.iou_thr:
+            raise ValueError('Cannot merge evaluators with different IoU thresholds: %f != %f'
+                             % (self.iou_thr, other.iou_thr))
+        if other.ignore_difficult != self.ignore_difficult or other.matching != self.matching:
+            raise ValueError('Cannot merge evaluators with different matching of boxes')
+        if other.size_mode != self.size_mode or other.size_edges != self.size_edges:
+            raise ValueError('Cannot merge evaluators with different size buckets')
+        for name in other.sizes:
+            self.sizes[name].merge(other.sizes[name])
+        common = self.images & other.images
+        if common:
+            logger.warning('Merging %d images evaluated in both evaluators' % len(common))
+        self.images.update(other.images)
+        for label in other.counts:
+            self._accumulate(label, other.counts[label], other.records[label])
+        return self
+
+    def totals(self, label=None):
+        """ Return the counts of a class or of all classes when `label` is None """
+        if label is not None:
+            return dict(self.counts.get(label, {'true_pos': 0, 'false_pos': 0, 'false_neg': 0}))
+        results = {'true_pos': 0, 'false_pos': 0, 'false_neg': 0}
+        for label in self.counts:
+            for key in results:
+                results[key] += self.counts[label][key]
+        return results
+
+    def scores(self, label=None):
+        """ Return (precision, recall, f_score) of a class or of all classes """
+        return accurary_scores(self.totals(label))
+
+    def average_precision(self, label):
+        """
+        Calculate the average precision (area under the interpolated
+        precision-recall curve) of a class, ranking predictions by score.
+        Predictions are matched in descending order of score (see
+        `score_matches`), independently of the `matching` of the counts.
+        """
+        records = self.records.get(label, [])
+        n_ground = self.counts.get(label, {}).get('true_pos', 0) + \
+                   self.counts.get(label, {}).get('false_neg', 0)
+        if not records or not n_ground:
+            return 0.0
+        records = np.array(records, dtype=np.float64)
+        order = np.argsort(-records[:, 0], kind='mergesort')
+        tp = np.cumsum(records[order, 1])
+        fp = np.cumsum(1 - records[order, 1])
+        recall = np.concatenate(([0.0], tp / n_ground, [1.0]))
+        precision = np.concatenate(([0.0], tp / (tp + fp), [0.0]))
+        precision = np.maximum.accumulate(precision[::-1])[::-1]
+        changes = np.nonzero(recall[1:] != recall[:-1])[0]
+        return float(np.sum((recall[changes+1] - recall[changes]) * precision[changes+1]))
+
+    def mean_average_precision(self):
+        """ Return the mean of the average precision of all classes in ground truth """
+        labels = [label for label in self.counts
+                  if self.counts[label]['true_pos'] + self.counts[label]['false_neg'] > 0]
+        if not labels:
+            return 0.0
+        return float(np.mean([self.average_precision(label) for label in labels]))
+
+    def to_dict(self):
+        dsizes = {}
+        for name in self.sizes:
+            dsizes[name] = self.sizes[name].to_dict()
+        return {'iou_thr': self.iou_thr, 'counts': self.counts,
+                'records': self.records, 'images': sorted(self.images),
+                'size_mode': self.size_mode, 'size_edges': self.size_edges,
+                'ignore_difficult': self.ignore_difficult, 'matching': self.matching,
+                'sizes': dsizes}
+
+    @classmethod
+    def from_dict(cls, dic):
+        evaluator = cls(iou_thr=dic['iou_thr'], size_mode=dic.get('size_mode'),
+                        size_edges=dic.get('size_edges'),
+                        ignore_difficult=dic.get('ignore_difficult', False),
+                        matching=dic.get('matching', 'greedy'))
+        evaluator.counts = dic['counts']
+        evaluator.records = dic['records']
+        evaluator.images = set(dic['images'])
+        for name in dic.get('sizes', {}):
+            evaluator.sizes[name] = cls.from_dict(dic['sizes'][name])
+        return evaluator
+
+    def save(self, output):
+        """ Save the partial state of the evaluator as a JSON file """
+        logger.info('Saving file %s' % output)
+        with utils.open_file(output, 'w') as outfile:
+            json.dump(self.to_dict(), outfile)
+
+    @classmethod
+    def load(cls, input):
+        """ Load an evaluator saved with `save()` """
+        logger.info('Reading file %s' % input)
+        with utils.open_file(input) as infile:
+            return cls.from_dict(json.load(infile))
+
+
+def generate_results(file_ground, file_pred, output=None, iou_thr=0.5, bootstrap=0, seed=0,
+                     size_mode=None, size_edges=None, file_cache=None, sample=None,
+                     policy='clip', ignore_difficult=False, matching='greedy'):
     if not output:
         fname, _ = splitext(basename(file_pred))
         output = join(dirname(file_pred), 'scores_'+fname+'.txt')
     logger.info('Saving file %s' % output)
     fout = open(output, 'w')
 
-    with open(file_ground) as infile:
-        dgt = json.load(infile)
-    dg = select_by_class(dgt)
-    with open(file_pred) as infile:
-        dpred = json.load(infile)
-    dp = select_by_class(dpred)
+    dgt = utils.read_json(file_ground)
+    sizes = utils.image_sizes(dgt)
+    dgt, _ = utils.validate_boxes(dgt, sizes=sizes, policy=policy)
+    dpred, _ = utils.validate_boxes(utils.read_json(file_pred), sizes=sizes, policy=policy)
+    # images without predictions still count their false negatives
+    images = sorted(set(dgt.keys()+dpred.keys()))
+    strata = weights = None
+    if sample:
+        nb_images = len(images)
+        images, strata, weights = stratified_sample(dgt, images, sample, seed=seed)
+        logger.info('Evaluating a sample of %d images out of %d' % (len(images), nb_images))
+        bootstrap = bootstrap or 1000
 
     # g_: ground p_: predicted
-    for id, img in enumerate(sorted(dp)):
-        g_img = dg[img]
-        p_img = dp[img]
-        dresults = image_results(g_img, p_img)
+    evaluator = Evaluator(iou_thr=iou_thr, size_mode=size_mode, size_edges=size_edges,
+                          ignore_difficult=ignore_difficult, matching=matching)
+    cache = None
+    if file_cache:
+        cache = ResultCache(file_cache)
+    counts = []
+    for id, img in enumerate(images):
+        dimg = evaluator.add(img, dgt.get(img, []), dpred.get(img, []), size=sizes.get(img),
+                             cache=cache)
+        dresults = {'true_pos': 0, 'false_pos': 0, 'false_neg': 0}
+        for label in dimg:
+            for key in dresults:
+                dresults[key] += dimg[label][key]
         scores = accurary_scores(dresults)
         fout.write('%s %f %f %f\n' % (img, scores[0], scores[1], scores[2]))
+        counts.append([dresults['true_pos'], dresults['false_pos'], dresults['false_neg']])
     fout.close()
+    if cache is not None:
+        cache.save(file_cache)
+    precision, recall, f_score = evaluator.scores()
+    if sample:
+        logger.info('Scores below are computed on the sampled images only')
+    logger.info('Precision: %f Recall: %f F-score: %f mAP: %f' %
+                (precision, recall, f_score, evaluator.mean_average_precision()))
+    for name in evaluator.size_names():
+        dsize = evaluator.sizes[name]
+        precision, recall, f_score = dsize.scores()
+        logger.info('Size %s: Precision: %f Recall: %f F-score: %f mAP: %f' %
+                    (name, precision, recall, f_score, dsize.mean_average_precision()))
 
-def calculate_image(dpred, dground, iou):
-    labels_pred = [obj[0] for obj in dpred[image]]
-    labels_ground = [obj[0] for obj in dground[image]]
-    labels = set(labels_pred).union(set(labels_ground))
-    for label in labels:
-        if dground.has_key(label):
-            vg = dground[label]
-        else:
-            vg = []
-        if dpred.has_key(label):
-            vp = dpred[label]
-        else:
-            vp = []
-        scores = get_single_image_results(vg, vp, 0.5)
-        print scores
-        
-
-def calculate(file_predict, file_ground, output, threshold):
-    dground = utils.read_json(file_ground) 
-    dpred = utils.read_json(file_predict) 
-
-    for image in dpred:
-        dp = {}
-        for obj in dpred[image]:
-            label, _, xmin, ymin, xmax, ymax = obj
-            if dp.has_key(label):
-                dp[label].append([xmin, ymin, xmax, ymax])
-            else:
-                dp[label] = [[xmin, ymin, xmax, ymax]]
-        dg = {}
-        for obj in dground[image]:
-            label, _, xmin, ymin, xmax, ymax = obj
-            if dg.has_key(label):
-                dg[label].append([xmin, ymin, xmax, ymax])
-            else:
-                dg[label] = [[xmin, ymin, xmax, ymax]]
-        for label in 
-        calculate_image(dp, dg, iou=threshold)
+    if bootstrap and counts:
+        counts = np.array(counts)
+        dboot = bootstrap_scores(counts[:, 0], counts[:, 1], counts[:, 2], bootstrap, seed=seed,
+                                 strata=strata, weights=weights)
+        for name in ['precision', 'recall', 'f_score']:
+            score, low, high = dboot[name]
+            logger.info('%s%s: %f (95%% CI: %f - %f, %d resamples)' %
+                        ('Estimated ' if sample else '', name, score, low, high, bootstrap))
 
 
-def main(file_predict, file_ground, output, threshold):
-    file_predict = realpath(file_predict)
-    file_ground = realpath(file_ground)
+def benchmark_matching(file_ground, file_pred, iou_thr=0.5, policy='clip', ignore_difficult=False):
+    """
+    Evaluate a file with greedy and optimal matching, reporting the time
+    spent by each method, their scores and the number of images where the
+    counts of true positives differ.
+    """
+    dgt = utils.read_json(file_ground)
+    sizes = utils.image_sizes(dgt)
+    dgt, _ = utils.validate_boxes(dgt, sizes=sizes, policy=policy)
+    dpred, _ = utils.validate_boxes(utils.read_json(file_pred), sizes=sizes, policy=policy)
+
+    dmethods = {}
+    for matching in ['greedy', 'optimal']:
+        evaluator = Evaluator(iou_thr=iou_thr, ignore_difficult=ignore_difficult, matching=matching)
+        dtp = {}
+        start = time.time()
+        for img in sorted(dpred):
+            dimg = evaluator.add(img, dgt.get(img, []), dpred[img])
+            dtp[img] = sum([dimg[label]['true_pos'] for label in dimg])
+        elapsed = time.time() - start
+        precision, recall, f_score = evaluator.scores()
+        logger.info('Matching %s: %f seconds Precision: %f Recall: %f F-score: %f mAP: %f' %
+                    (matching, elapsed, precision, recall, f_score, evaluator.mean_average_precision()))
+        dmethods[matching] = (evaluator, dtp, elapsed)
+
+    greedy, optimal = dmethods['greedy'], dmethods['optimal']
+    changed = [img for img in greedy[1] if greedy[1][img] != optimal[1][img]]
+    logger.info('Optimal/greedy time: %f' % (optimal[2] / max(greedy[2], 1e-9)))
+    logger.info('True positives: greedy %d optimal %d (images with different counts: %d)' %
+                (greedy[0].totals()['true_pos'], optimal[0].totals()['true_pos'], len(changed)))
+    return dmethods
+
+
+def _evaluate_model(args):
+    """
+    Evaluate all images of a single model against the ground truth. Returns
+    a dictionary {image: {label: (tp, fp, fn, [matched ground truth indices])}}
+    """
+    dgt, sizes, file_pred, iou_thr, policy, ignore_difficult, matching = args
+    dpred, _ = utils.validate_boxes(utils.read_json(file_pred), sizes=sizes, policy=policy)
+    evaluator = Evaluator(iou_thr=iou_thr, ignore_difficult=ignore_difficult, matching=matching)
+    dmodel = {}
+    for img in set(dgt.keys()+dpred.keys()):
+        dmatches = evaluator.match_image(dgt.get(img, []), dpred.get(img, []))
+        dimg = {}
+        for label in dmatches:
+            vg, vp, gt_match_idx, pred_match_idx = dmatches[label]
+            dimg[label] = (len(gt_match_idx), len(vp) - len(pred_match_idx),
+                           len(vg) - len(gt_match_idx), gt_match_idx)
+        dmodel[img] = dimg
+    return dmodel
+
+
+def model_name(fname):
+    """ Return the name of a file without path and extension (including `.gz`) """
+    fname = basename(fname)
+    if fname.endswith('.gz'):
+        fname = fname[:-3]
+    return splitext(fname)[0]
+
+
+def compare_results(file_ground, files_pred, output=None, iou_thr=0.5, n_jobs=1,
+                    policy='clip', ignore_difficult=False, matching='greedy'):
+    """
+    Evaluate several prediction files against the same ground truth, which
+    is loaded a single time. Models may be evaluated in parallel processes.
+    The output file contains a side-by-side table with true positives, false
+    positives and false negatives of each model for each image and class:
+
+        <image> <class> <tp_model1> <fp_model1> <fn_model1> <tp_model2> ...
+
+    Paired statistics are saved in `<output>_paired.txt` with the form:
+
+        <model A> <model B> <both> <only A> <only B> <none> <images only A> <images only B>
+
+    where `both`, `only A`, `only B` and `none` count ground truth objects
+    detected by both models, only by A, only by B or by none of them, and
+    `images only A` counts images with at least one object detected by A and
+    missed by B.
+    """
     if not output:
-        dirin = dirname(file_predict)
-        output = join(dirin, 'output.csv')
+        output = join(dirname(files_pred[0]), 'compare.txt')
+    models = [model_name(fname) for fname in files_pred]
+
+    dgt = utils.read_json(file_ground)
+    sizes = utils.image_sizes(dgt)
+    dgt, _ = utils.validate_boxes(dgt, sizes=sizes, policy=policy)
+    tasks = [(dgt, sizes, fname, iou_thr, policy, ignore_difficult, matching) for fname in files_pred]
+    if n_jobs > 1:
+        from multiprocessing import Pool
+        pool = Pool(min(n_jobs, len(tasks)))
+        dmodels = pool.map(_evaluate_model, tasks)
+        pool.close()
+        pool.join()
+    else:
+        dmodels = [_evaluate_model(task) for task in tasks]
 
-    calculate(file_predict, file_ground, output, threshold)
+    images = set()
+    for dmodel in dmodels:
+        images.update(dmodel.keys())
+
+    logger.info('Saving file %s' % output)
+    fout = open(output, 'w')
+    fout.write('image class %s\n' % ' '.join(['tp_%s fp_%s fn_%s' % (m, m, m) for m in models]))
+    for img in sorted(images):
+        labels = set()
+        for dmodel in dmodels:
+            labels.update(dmodel.get(img, {}).keys())
+        for label in sorted(labels):
+            row = []
+            for dmodel in dmodels:
+                tp, fp, fn, _ = dmodel.get(img, {}).get(label, (0, 0, 0, []))
+                row.extend([tp, fp, fn])
+            fout.write('%s %s %s\n' % (img, label, ' '.join(map(str, row))))
+    fout.close()
+
+    fname, _ = splitext(output)
+    output_paired = fname+'_paired.txt'
+    logger.info('Saving file %s' % output_paired)
+    fout = open(output_paired, 'w')
+    # ground truth objects that are evaluated, i.e., tp + fn of any model
+    total = 0
+    for img in dmodels[0]:
+        for label in dmodels[0][img]:
+            total += dmodels[0][img][label][0] + dmodels[0][img][label][2]
+    for i in range(len(models)):
+        for j in range(i+1, len(models)):
+            both = only_a = only_b = img_a = img_b = 0
+            for img in images:
+                labels = set(dmodels[i].get(img, {}).keys()+dmodels[j].get(img, {}).keys())
+                hit_a = hit_b = 0
+                for label in labels:
+                    ma = set(dmodels[i].get(img, {}).get(label, (0, 0, 0, []))[3])
+                    mb = set(dmodels[j].get(img, {}).get(label, (0, 0, 0, []))[3])
+                    both += len(ma & mb)
+                    hit_a += len(ma - mb)
+                    hit_b += len(mb - ma)
+                only_a += hit_a
+                only_b += hit_b
+                if hit_a: img_a += 1
+                if hit_b: img_b += 1
+            none = total - both - only_a - only_b
+            fout.write('%s %s %d %d %d %d %d %d\n' % (models[i], models[j], both,
+                       only_a, only_b, none, img_a, img_b))
+            logger.info('%s vs %s: objects detected only by %s: %d, only by %s: %d (images: %d, %d)' %
+                        (models[i], models[j], models[i], only_a, models[j], only_b, img_a, img_b))
+    fout.close()
+
+
+def main(file_predict, file_ground, output, threshold, bootstrap=0, seed=0,
+         compare=None, n_jobs=1, size_mode=None, size_edges=None, file_cache=None,
+         sample=None, policy='clip', ignore_difficult=False, matching='greedy',
+         benchmark=False):
+    file_predict = realpath(file_predict)
+    file_ground = realpath(file_ground)
+    if compare:
+        files_pred = [file_predict] + [realpath(fname) for fname in compare]
+        compare_results(file_ground, files_pred, output=output, iou_thr=threshold, n_jobs=n_jobs,
+                        policy=policy, ignore_difficult=ignore_difficult, matching=matching)
+        return
+    if benchmark:
+        benchmark_matching(file_ground, file_predict, iou_thr=threshold, policy=policy,
+                           ignore_difficult=ignore_difficult)
+        return
+    generate_results(file_ground, file_predict, output=output, iou_thr=threshold,
+                     bootstrap=bootstrap, seed=seed, size_mode=size_mode, size_edges=size_edges,
+                     file_cache=file_cache, sample=sample, policy=policy,
+                     ignore_difficult=ignore_difficult, matching=matching)
     
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('predicted', metavar='file_predicted', help='File containing predicted bounding boxes')
     parser.add_argument('groundtruth', metavar='file_ground', help='File containing ground truth for all images')
-    parser.add_argument('-o', '--output', help='File to save the generated json file', default=None)
-    parser.add_argument('-t', '--threshold', help='Apply threshold on Intersection over Union (IoU)', default=0.5)
-    #parser.add_argument('-m', '--mode', help='Mode of pre-processing (align_files|apply_threshold)', default='align_files')
+    parser.add_argument('-o', '--output', help='File to save the scores of each image', default=None)
+    parser.add_argument('-t', '--threshold', help='Apply threshold on Intersection over Union (IoU)', type=float, default=0.5)
+    parser.add_argument('-b', '--bootstrap', help='Number of bootstrap resamples for confidence intervals', type=int, default=0)
+    parser.add_argument('-s', '--seed', help='Seed of the random generator', type=int, default=0)
+    parser.add_argument('-c', '--compare', help='Other files with predicted bounding boxes to compare against file_predicted', nargs='+', default=None)
+    parser.add_argument('-j', '--jobs', help='Number of processes to evaluate models in compare mode', type=int, default=1)
+    parser.add_argument('-z', '--sizes', help='Evaluate by object size using absolute area or ratio to the image (area|ratio)', default=None)
+    parser.add_argument('-e', '--size_edges', help='Edges of the object size buckets', type=float, nargs='+', default=None)
+    parser.add_argument('-r', '--cache', help='File to cache the results of each image between runs', default=None)
+    parser.add_argument('-a', '--sample', help='Evaluate a stratified sample of images: fraction (<1) or number of images', type=float, default=None)
+    parser.add_argument('-p', '--policy', help='Policy for invalid bounding boxes (clip|drop|fail)', default='clip')
+    parser.add_argument('-d', '--ignore_difficult', help='Ignore ground truth boxes flagged as difficult', action='store_true')
+    parser.add_argument('-g', '--matching', help='Matching of bounding boxes (greedy|optimal)', default='greedy')
+    parser.add_argument('-k', '--benchmark', help='Compare runtime and scores of greedy and optimal matching', action='store_true')
     args = parser.parse_args()
 
-    main(args.predicted, args.groundtruth, args.output, args.threshold)
+    main(args.predicted, args.groundtruth, args.output, args.threshold,
+         bootstrap=args.bootstrap, seed=args.seed, compare=args.compare, n_jobs=args.jobs,
+         size_mode=args.sizes, size_edges=args.size_edges, file_cache=args.cache,
+         sample=args.sample, policy=args.policy, ignore_difficult=args.ignore_difficult,
+         matching=args.matching, benchmark=args.benchmark)
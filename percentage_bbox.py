@@ -11,9 +11,10 @@ logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=lo
 import argparse
 import sys
 from os import walk
-from os.path import join, isdir, dirname, basename, realpath, splitext
+from os.path import join, isdir, isfile, dirname, basename, realpath, splitext
 from xml.dom import minidom
 import progressbar
+import utils
 
 def percentage_bounding_boxes(folder_input):
     """
@@ -78,29 +79,64 @@ def percentage_bounding_boxes(folder_input):
     
                 area_bbox += (xmax - xmin) * (ymax - ymin)
             area_img = width * height
-            ratio = float(area_bbox) / area_img
-            if   ratio <= 0.1: dic[0.1] += 1
-            elif ratio <= 0.2: dic[0.2] += 1
-            elif ratio <= 0.3: dic[0.3] += 1
-            elif ratio <= 0.4: dic[0.4] += 1
-            elif ratio <= 0.5: dic[0.5] += 1
-            elif ratio <= 0.6: dic[0.6] += 1
-            elif ratio <= 0.7: dic[0.7] += 1
-            elif ratio <= 0.8: dic[0.8] += 1
-            elif ratio <= 0.9: dic[0.9] += 1
-            elif ratio <= 1.0: dic[1.0] += 1
+            add_ratio(dic, float(area_bbox) / area_img)
+    for ratio in sorted(dic):
+        logger.info('Ratio - Images: %f : %d' % (ratio, dic[ratio]))
+
+
+def add_ratio(dic, ratio):
+    """ Increment the bin of `dic` corresponding to `ratio` """
+    if   ratio <= 0.1: dic[0.1] += 1
+    elif ratio <= 0.2: dic[0.2] += 1
+    elif ratio <= 0.3: dic[0.3] += 1
+    elif ratio <= 0.4: dic[0.4] += 1
+    elif ratio <= 0.5: dic[0.5] += 1
+    elif ratio <= 0.6: dic[0.6] += 1
+    elif ratio <= 0.7: dic[0.7] += 1
+    elif ratio <= 0.8: dic[0.8] += 1
+    elif ratio <= 0.9: dic[0.9] += 1
+    elif ratio <= 1.0: dic[1.0] += 1
+
+
+def percentage_bounding_boxes_json(file_ground):
+    """
+    Generates the number of images for each value of percentage from a ground
+    truth file converted by `convert_to_json.py`, which keeps the size of the
+    images, thus XML files are not parsed again.
+    """
+    dic = {0.0: 0, 0.1: 0, 0.2: 0, 0.3: 0, 0.4: 0, 0.5: 0, 
+           0.6: 0, 0.7: 0, 0.8: 0, 0.9: 0, 1.0: 0}
+    dground = utils.read_json(file_ground)
+    sizes = utils.image_sizes(dground)
+    pb = progressbar.ProgressBar(len(dground))
+    for image in sorted(dground):
+        pb.update()
+        if not dground[image]:
+            continue
+        if not sizes.has_key(image):
+            logger.info('Skipping image without size: %s' % image)
+            continue
+        width, height = sizes[image]
+        area_bbox = 0
+        for obj in dground[image]:
+            _, _, xmin, ymin, xmax, ymax = obj[:6]
+            area_bbox += (xmax - xmin) * (ymax - ymin)
+        add_ratio(dic, float(area_bbox) / (width * height))
     for ratio in sorted(dic):
         logger.info('Ratio - Images: %f : %d' % (ratio, dic[ratio]))
 
 
 def main(file_ground):
     file_ground = realpath(file_ground)
-    percentage_bounding_boxes(file_ground)
+    if isfile(file_ground):
+        percentage_bounding_boxes_json(file_ground)
+    else:
+        percentage_bounding_boxes(file_ground)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument('groundtruth', metavar='file_ground', help='File containing ground truth for all images')
+    parser.add_argument('groundtruth', metavar='file_ground', help='Folder containing XML files or JSON file converted from them')
     args = parser.parse_args()
 
     main(args.groundtruth)
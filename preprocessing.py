@@ -18,6 +18,9 @@ are previously converted to JSON format in the form:
 } 
 
 # Pipeline of Pre-Processing:
+  - Check bounding boxes and remove invalid ones (report saved in faster_valid_report.txt)
+     $ python preprocessing.py -o faster_valid.json -m validate -p drop faster.json
+
   - Remove classes from faster and leannet that do not belong to ground truth
      $ python preprocessing.py -o faster_gt.json -m check_classes -g GT.json faster.json 
      $ python preprocessing.py -o leannet_gt.json -m check_classes -g GT.json leannet.json 
@@ -25,6 +28,10 @@ are previously converted to JSON format in the form:
   - Apply threshold on faster_cor.json and leannet_cor.json [set to 0.5]
      $ python preprocessing.py -o leannet_0.5.json -m apply_threshold leannet_gt.json
      $ python preprocessing.py -o faster_0.5.json -m apply_threshold faster_gt.json
+    Optionally, keep only the 100 highest-scoring boxes of each class in each image
+     $ python preprocessing.py -o faster_0.5.json -m apply_threshold -k 100 -c faster_gt.json
+    Several thresholds in a single pass (generates faster_0.1.json, faster_0.3.json, ...)
+     $ python preprocessing.py -o faster.json -m apply_threshold -t 0.1 0.3 0.5 0.7 0.9 faster_gt.json
 
   - Remove all images that do not appear the three: faster.json, leannet.json and GT.json
      $ python preprocessing.py -o leannet_tmp.json -m align_files -g GT.json leannet_0.5.json
@@ -36,36 +43,146 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
 import argparse
 import sys
-from os.path import join, dirname
+from os.path import join, dirname, splitext
 from os.path import realpath, isfile
 import json
+import heapq
+from bisect import bisect_right
+from operator import itemgetter
 import progressbar
 import misc
 import utils
 
 
-def apply_threshold(file_predict, output, threshold):
+def select_top_k(detections, top_k, per_class=False):
+    """
+    Keep the `top_k` detections with highest scores of a single image.
+    Selection is partial (heap based), thus it does not sort the whole
+    list of detections.
+
+    Parameters:
+    -----------
+    detections : list
+        list of detections in the form [<class>, <score>, <xmin>, <ymin>, <xmax>, <ymax>]
+    top_k : int
+        maximum number of detections to keep
+    per_class : bool
+        if True, keep `top_k` detections for each class of the image
+
+    Returns:
+    --------
+        list: detections that were kept (in score order when `per_class` is True)
+    """
+    if not per_class:
+        if len(detections) <= top_k:
+            return detections
+        return heapq.nlargest(top_k, detections, key=itemgetter(1))
+    dclass = {}
+    for content in detections:
+        if dclass.has_key(content[0]):
+            dclass[content[0]].append(content)
+        else:
+            dclass[content[0]] = [content]
+    kept = []
+    for label in dclass:
+        kept.extend(select_top_k(dclass[label], top_k))
+    return sorted(kept, key=itemgetter(1), reverse=True)
+
+
+def select_top_k_sorted(ranked, top_k, per_class=False):
+    """
+    Keep the `top_k` detections with highest scores of a list of
+    detections already sorted by decreasing score (see `select_top_k`).
+    The order of the detections is preserved.
+    """
+    if not per_class:
+        return ranked[:top_k]
+    dclass = {}
+    kept = []
+    for content in ranked:
+        nb = dclass.get(content[0], 0)
+        if nb < top_k:
+            dclass[content[0]] = nb + 1
+            kept.append(content)
+    return kept
+
+
+def threshold_output(output, threshold):
+    """ Return the name of the output file of a threshold, e.g., output_0.5.json """
+    fname, ext = splitext(output)
+    if ext == '.gz':
+        fname, ext2 = splitext(fname)
+        ext = ext2 + ext
+    return '%s_%g%s' % (fname, threshold, ext)
+
+
+def apply_threshold(file_predict, output, thresholds, top_k=None, per_class=False):
     """
     Apply threshold on the scores of a predicted file, reducing
-    the number of predicted bounding boxes.
+    the number of predicted bounding boxes. When `top_k` is set,
+    only the `top_k` highest-scoring bounding boxes of each image
+    (or of each class in the image when `per_class` is True) that
+    pass the threshold are kept.
+
+    `thresholds` may be a list of thresholds, in which case all output
+    files are generated reading the predicted file a single time and
+    each file is named after its threshold (see `threshold_output`).
+    The detections of each image are sorted by score once and each
+    threshold keeps a prefix of this order. A single threshold only
+    filters the detections, without sorting them.
     """
+    if not isinstance(thresholds, (list, tuple)):
+        thresholds = [thresholds]
+    thresholds = sorted(set(thresholds))
     dpred = utils.read_json(file_predict)
-    
-    dic = {}
-    discarded = 0
-    pb = progressbar.ProgressBar(len(dpred))
-    for image in sorted(dpred):
-        for content in dpred[image]:
-            if content[1] >= threshold:
-                if dic.has_key(image):
-                    dic[image].append(content)
-                else:
-                    dic[image] = [content]
-            else:
-                discarded += 1
-        pb.update()
-    utils.save_json(output, dic)
-    logger.info('Total of discarded bounding boxes: %d' % discarded)
+
+    if len(thresholds) == 1:
+        outputs = [output]
+    else:
+        outputs = [threshold_output(output, threshold) for threshold in thresholds]
+    writers = []
+    discarded = [0] * len(thresholds)
+    discarded_k = [0] * len(thresholds)
+    try:
+        for fname in outputs:
+            writers.append(utils.JSONWriter(fname))
+        pb = progressbar.ProgressBar(len(dpred))
+        for image in sorted(dpred):
+            if len(thresholds) == 1:
+                kept = [content for content in dpred[image] if content[1] >= thresholds[0]]
+                discarded[0] += len(dpred[image]) - len(kept)
+                if top_k is not None:
+                    nb_kept = len(kept)
+                    kept = select_top_k(kept, top_k, per_class=per_class)
+                    discarded_k[0] += nb_kept - len(kept)
+                if kept:
+                    writers[0].write(image, kept)
+                pb.update()
+                continue
+            ranked = sorted(dpred[image], key=itemgetter(1), reverse=True)
+            scores = [-content[1] for content in ranked]
+            for i, threshold in enumerate(thresholds):
+                # number of detections with score >= threshold
+                cut = bisect_right(scores, -threshold)
+                discarded[i] += len(ranked) - cut
+                kept = ranked[:cut]
+                if top_k is not None:
+                    kept = select_top_k_sorted(kept, top_k, per_class=per_class)
+                    discarded_k[i] += cut - len(kept)
+                if kept:
+                    writers[i].write(image, kept)
+            pb.update()
+    except:
+        for writer in writers:
+            writer.abort()
+        raise
+    for writer in writers:
+        writer.close()
+    for i, threshold in enumerate(thresholds):
+        logger.info('Total of discarded bounding boxes (threshold %g): %d' % (threshold, discarded[i]))
+        if top_k is not None:
+            logger.info('Total of bounding boxes discarded by top-%d (threshold %g): %d' %
+                        (top_k, threshold, discarded_k[i]))
 
 
 def align_files(file_predict, file_ground, output):
@@ -112,7 +229,34 @@ def check_classes(file_predict, file_ground, output):
     utils.save_json(output, dic)
 
 
-def main(file_predict, file_ground, output, mode, threshold):
+def validate(file_predict, output, policy, file_ground=None):
+    """
+    Check all bounding boxes of a file and save the valid ones. Boxes outside
+    the image are checked using the size of the images stored in the ground
+    truth file (when given) or in the input file itself. The report
+    with all invalid boxes is saved in `<output>_report.txt` in the form:
+
+        <image> <index of the box> <error>
+    """
+    dpred = utils.read_json(file_predict)
+    if file_ground:
+        sizes = utils.image_sizes(utils.read_json(file_ground))
+    else:
+        sizes = utils.image_sizes(dpred)
+    dic, report = utils.validate_boxes(dpred, sizes=sizes, policy=policy)
+    fname, _ = splitext(output)
+    if fname.endswith('.json'):
+        fname, _ = splitext(fname)
+    output_report = fname+'_report.txt'
+    logger.info('Saving file %s' % output_report)
+    with open(output_report, 'w') as fout:
+        for image, idx, error in report:
+            fout.write('%s %d %s\n' % (image, idx, error))
+    utils.save_json(output, dic)
+
+
+def main(file_predict, file_ground, output, mode, threshold, top_k=None, per_class=False,
+         policy='clip'):
     if not output:
         dirin = dirname(file_predict)
         output = join(dirin, 'output.json')
@@ -120,9 +264,11 @@ def main(file_predict, file_ground, output, mode, threshold):
     if mode.lower() == 'align_files':
         align_files(file_ground, file_predict, output)
     elif mode.lower() == 'apply_threshold':
-        apply_threshold(file_predict, output, threshold)
+        apply_threshold(file_predict, output, threshold, top_k=top_k, per_class=per_class)
     elif mode.lower() == 'check_classes':
         check_classes(file_predict, file_ground, output)
+    elif mode.lower() == 'validate':
+        validate(file_predict, output, policy, file_ground=file_ground)
     else:
         logger.error('Mode for pre-processing is not correct: %s' % mode)
 
@@ -132,8 +278,12 @@ if __name__ == "__main__":
     parser.add_argument('predicted', metavar='file_predicted', help='File containing predicted bounding boxes', default=None)
     parser.add_argument('-g', '--groundtruth', help='File containing ground truth for all images', default=None)
     parser.add_argument('-o', '--output', help='File to save the generated json file', default=None)
-    parser.add_argument('-t', '--threshold', help='Apply threshold on predicted scores', default=0.5)
-    parser.add_argument('-m', '--mode', help='Mode of pre-processing (align_files|apply_threshold|check_classes)', default='align_files')
+    parser.add_argument('-t', '--threshold', help='Apply threshold(s) on predicted scores', type=float, nargs='+', default=[0.5])
+    parser.add_argument('-k', '--top_k', help='Keep only the K highest-scoring bounding boxes of each image', type=int, default=None)
+    parser.add_argument('-c', '--per_class', help='Apply top K for each class of the image', action='store_true')
+    parser.add_argument('-m', '--mode', help='Mode of pre-processing (align_files|apply_threshold|check_classes|validate)', default='align_files')
+    parser.add_argument('-p', '--policy', help='Policy for invalid bounding boxes in validate mode (clip|drop|fail)', default='clip')
     args = parser.parse_args()
 
-    main(args.predicted, args.groundtruth, args.output, args.mode, args.threshold)
+    main(args.predicted, args.groundtruth, args.output, args.mode, args.threshold,
+         top_k=args.top_k, per_class=args.per_class, policy=args.policy)
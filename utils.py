@@ -9,9 +9,15 @@ import logging
 logger = logging.getLogger(__name__)
 logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
 import sys
+from os import remove
 from os.path import realpath, isfile
 import progressbar
 import json
+import gzip
+import numpy as np
+
+# policies to handle invalid bounding boxes
+POLICIES = ['fail', 'drop', 'clip']
 
 def check_file(input):
     input = realpath(input)
@@ -21,16 +27,275 @@ def check_file(input):
     return input
 
 
-def save_json(output, dic):
-    logger.info('Saving file %s' % output)
-    with open(output, 'w') as outfile:
-        json.dump(dout, outfile)
+def open_file(fname, mode='r'):
+    """
+    Open a file for reading or writing. Files with extension `.gz` are
+    transparently compressed/decompressed with gzip.
+    """
+    if fname.endswith('.gz'):
+        return gzip.open(fname, mode+'b')
+    return open(fname, mode)
+
+
+class JSONWriter(object):
+    """
+    Write a JSON dictionary of images in the form {image: [...], ...}
+    incrementally, i.e., each image is written to disk as soon as it is
+    produced instead of keeping the whole dictionary in memory. The output
+    is compressed with gzip when its name ends with `.gz`.
+
+    When `index` is True, a sidecar file `<output>.idx` is also saved with
+    the byte offset and length of the content of each image in the form
+    {image: [offset, length]}, which allows `read_images` to fetch single
+    images without parsing the whole file. Offsets refer to the uncompressed
+    stream, thus seeking is only fast for plain (not gzip) files. Each image
+    must be written a single time.
+
+    Usage:
+    ------
+        with JSONWriter('output.json.gz') as writer:
+            for image in images:
+                writer.write(image, content)
+
+    When an exception leaves the `with` block, the incomplete output is
+    removed (see `abort`) instead of being closed as a valid JSON file.
+    """
+    def __init__(self, output, index=False):
+        logger.info('Saving file %s' % output)
+        self.output = output
+        self.total = 0
+        self.offset = 0
+        self.index = {} if index else None
+        self.images = set()
+        if not index and isfile(output+'.idx'):
+            # the index would not correspond to the new content of the file
+            logger.info('Removing outdated index %s' % (output+'.idx'))
+            remove(output+'.idx')
+        self.fout = open_file(output, 'w')
+        self._write('{')
+
+    def _write(self, text):
+        self.fout.write(text)
+        self.offset += len(text)
+
+    def write(self, image, content):
+        """ Write the content of a single image """
+        if image in self.images:
+            # json.load would silently keep only the last content of the image
+            logger.error('Image already written to %s: %s' % (self.output, image))
+            sys.exit(1)
+        self.images.add(image)
+        if self.total:
+            self._write(', ')
+        self._write('%s: ' % json.dumps(image))
+        content = json.dumps(content)
+        if self.index is not None:
+            self.index[image] = [self.offset, len(content)]
+        self._write(content)
+        self.total += 1
+
+    def close(self):
+        if self.fout:
+            self._write('}')
+            self.fout.close()
+            self.fout = None
+            if self.index is not None:
+                logger.info('Saving file %s' % (self.output+'.idx'))
+                with open(self.output+'.idx', 'w') as outfile:
+                    json.dump(self.index, outfile)
+
+    def abort(self):
+        """ Close and remove an incomplete output, so it is not taken as a valid file """
+        if self.fout:
+            self.fout.close()
+            self.fout = None
+            logger.warning('Removing incomplete file %s' % self.output)
+            remove(self.output)
+            if isfile(self.output+'.idx'):
+                remove(self.output+'.idx')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def save_json(output, dic, index=False):
+    with JSONWriter(output, index=index) as writer:
+        for image in sorted(dic):
+            writer.write(image, dic[image])
+
+
+def validate_boxes(dic, sizes=None, policy='clip'):
+    """
+    Check all bounding boxes of a file at once, finding boxes with invalid
+    coordinates (NaN or infinite), inverted coordinates (xmin > xmax or
+    ymin > ymax), coordinates outside the image and boxes that do not overlap
+    the image at all (when the size of the image is known) and duplicated
+    boxes (same class and coordinates in an image). Duplicated boxes are
+    only reported, except with the `drop` policy: duplicated predictions are
+    real false positives and must be kept in the evaluation.
+
+    Parameters:
+    -----------
+    dic : dict
+        dictionary in the form {image: [[<class>, <score>, <xmin>, <ymin>, <xmax>, <ymax>], ...]}
+    sizes : dict
+        size of the images in the form {image: (width, height)}
+    policy : string
+        how to handle invalid boxes:
+            clip: clip boxes to the image and remove boxes with invalid or inverted
+                  coordinates and boxes outside the image (default)
+            drop: remove invalid and duplicated boxes
+            fail: report the errors and exit with error status
+
+    Returns:
+    --------
+        tuple: (dic, report), where `dic` contains the remaining boxes and `report`
+            is a list of (image, index of the box, error)
+    """
+    if policy not in POLICIES:
+        logger.error('Policy for invalid boxes is not correct: %s' % policy)
+        sys.exit(1)
+    images = sorted(dic)
+    n_boxes = [len(dic[image]) for image in images]
+    img_idx = np.repeat(np.arange(len(images)), n_boxes)
+    pos_idx = np.concatenate([np.arange(n) for n in n_boxes]) if images else np.zeros(0, dtype=int)
+    objs = [obj for image in images for obj in dic[image]]
+    boxes = np.array([obj[2:6] for obj in objs], dtype=np.float64).reshape(-1, 4)
+    label_ids = {}
+    labels = np.array([label_ids.setdefault(obj[0], len(label_ids)) for obj in objs], dtype=np.int64)
+
+    errors = {}
+    with np.errstate(invalid='ignore'):
+        errors['invalid coordinates'] = ~np.isfinite(boxes).all(axis=1)
+        errors['inverted coordinates'] = (boxes[:, 0] > boxes[:, 2]) | (boxes[:, 1] > boxes[:, 3])
+        outside = np.zeros(len(boxes), dtype=bool)
+        beyond = np.zeros(len(boxes), dtype=bool)
+        if sizes:
+            wh = np.array([sizes.get(images[i], (np.inf, np.inf)) for i in range(len(images))],
+                          dtype=np.float64).reshape(-1, 2)[img_idx]
+            outside = (boxes[:, 0] < 0) | (boxes[:, 1] < 0) | \
+                      (boxes[:, 2] > wh[:, 0]) | (boxes[:, 3] > wh[:, 1])
+            # clipping these boxes would only leave a line on the border
+            beyond = (boxes[:, 2] < 0) | (boxes[:, 3] < 0) | \
+                     (boxes[:, 0] > wh[:, 0]) | (boxes[:, 1] > wh[:, 1])
+        errors['outside the image'] = outside & ~beyond
+        errors['no overlap with the image'] = beyond
+        # boxes identical to a box of the same class and higher score in the same image
+        scores = np.array([obj[1] for obj in objs], dtype=np.float64)
+        order = np.lexsort((-scores, boxes[:, 3], boxes[:, 2], boxes[:, 1], boxes[:, 0],
+                            labels, img_idx))
+        keys = np.column_stack((img_idx, labels, boxes))[order]
+        same = np.zeros(len(boxes), dtype=bool)
+        if len(boxes) > 1:
+            same[order[1:]] = (keys[1:] == keys[:-1]).all(axis=1)
+        errors['duplicated box'] = same
+
+    report = []
+    for error in sorted(errors):
+        for i in np.nonzero(errors[error])[0]:
+            report.append((images[img_idx[i]], int(pos_idx[i]), error))
+        if errors[error].any():
+            logger.warning('Invalid bounding boxes (%s): %d' % (error, errors[error].sum()))
+    report.sort()
+    if not report:
+        return dic, report
+    if policy == 'fail':
+        for image, idx, error in report[:10]:
+            logger.error('Image %s box %d: %s' % (image, idx, error))
+        logger.error('Total of invalid bounding boxes: %d' % len(report))
+        sys.exit(1)
+
+    invalid = errors['invalid coordinates'] | errors['inverted coordinates'] | \
+              errors['no overlap with the image']
+    if policy == 'clip' and sizes:
+        boxes[:, [0, 2]] = np.clip(boxes[:, [0, 2]], 0, wh[:, [0]])
+        boxes[:, [1, 3]] = np.clip(boxes[:, [1, 3]], 0, wh[:, [1]])
+    elif policy == 'drop':
+        invalid |= errors['outside the image'] | errors['duplicated box']
+
+    dout = dict((image, []) for image in images)
+    for i, obj in enumerate(objs):
+        if invalid[i]:
+            continue
+        if errors['outside the image'][i]:
+            obj = obj[:2] + [type(c)(b) for c, b in zip(obj[2:6], boxes[i])] + obj[6:]
+        dout[images[img_idx[i]]].append(obj)
+    logger.info('Total of removed bounding boxes: %d' % invalid.sum())
+    return dout, report
+
+
+def image_sizes(dic):
+    """
+    Return the size of the images of a ground truth file converted with
+    `convert_to_json.convert_xml`, i.e., objects in the form
+    [<class>, <score>, <xmin>, <ymin>, <xmax>, <ymax>, <width>, <height>, ...],
+    as a dictionary {image: (width, height)}. Images without size are skipped.
+    """
+    sizes = {}
+    for image in dic:
+        for obj in dic[image]:
+            if len(obj) > 7 and obj[6] and obj[7]:
+                sizes[image] = (obj[6], obj[7])
+                break
+    return sizes
 
 
 def read_json(input):
     logger.info('Reading file %s' % input)
-    with open(input) as infile:
+    with open_file(input) as infile:
         dic = json.load(infile)
     return dic
 
 
+def read_index(input):
+    """
+    Read the sidecar index `<input>.idx` saved by `JSONWriter`. Returns
+    a dictionary {image: [offset, length]} or None if there is no index.
+    """
+    if not isfile(input+'.idx'):
+        return None
+    with open(input+'.idx') as infile:
+        return json.load(infile)
+
+
+def read_images(input, images=None):
+    """
+    Read the content of some images of a JSON file. When the file has a
+    sidecar index, only the content of the requested images is read by
+    seeking directly to them; otherwise, the whole file is loaded.
+
+    Parameters:
+    -----------
+    input : string
+        path to the JSON file
+    images : list
+        names of the images to read (all images if None)
+
+    Returns:
+    --------
+        dict: content of the images in the form {image: [...]}
+    """
+    dindex = read_index(input)
+    if dindex is None:
+        logger.info('No index found for file %s' % input)
+        dic = read_json(input)
+        if images is None:
+            return dic
+        return dict((image, dic[image]) for image in images if dic.has_key(image))
+    if images is None:
+        images = dindex.keys()
+    selected = sorted([image for image in images if dindex.has_key(image)],
+                      key=lambda image: dindex[image][0])
+    dic = {}
+    with open_file(input) as infile:
+        for image in selected:
+            offset, length = dindex[image]
+            infile.seek(offset)
+            dic[image] = json.loads(infile.read(length))
+    return dic